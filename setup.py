@@ -1,14 +1,37 @@
+import os
+
 from setuptools import find_packages, setup
 
+ext_modules = []
+# NOTE: compiling with mypyc is opt-in, as it needs mypy at build time.
+# The plan visitors are left out, mypyc can't compile them yet.
+if os.environ.get("SOUFFLE_TOOLS_MYPYC"):
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(
+        [
+            "souffle_tools/visitors/utils.py",
+            "souffle_tools/visitors/relations.py",
+            "souffle_tools/visitors/indexes.py",
+        ]
+    )
+
+# NOTE: so is compiling the plan emitter with Cython (3.0 or later), ram_plan.py falls back to Python without it.
+if os.environ.get("SOUFFLE_TOOLS_CYTHON"):
+    from Cython.Build import cythonize
+
+    ext_modules += cythonize(["souffle_tools/visitors/_plan_emit.pyx"])
+
 setup(
     name="souffle-tools",
     description="Utilities for the Souffle programming language.",
     version="1.0.0",
     packages=find_packages(),
-    install_requires=["lark", "typer"],
+    install_requires=["lark", "lark_cython", "typer"],
     package_data={
         "souffle_tools": [
             "grammars/*.lark",
         ],
     },
+    ext_modules=ext_modules,
 )
@@ -1,16 +1,23 @@
+import functools
+import os
 from typing import List
 
 import typer
 
+from .context import SouffleCtx
 from .visitors.plan import PyPlanVisitor
-from .visitors.ram_simplify import RAMSimplifier
 from .visitors.indexes import IndexVisitor
-from .visitors.relations import RelationVisitor
-from .parsers import ram, souffle
+from .parsers import souffle
 
 app = typer.Typer()
 
 
+@functools.lru_cache(maxsize=8)
+def _context(file: str) -> SouffleCtx:
+    # NOTE: shared by all the commands run on a file in this process.
+    return SouffleCtx(os.path.abspath(file))
+
+
 @app.command()
 def parse_files(files: List[str], use_transformed: bool = False):
     """
@@ -28,12 +35,7 @@ def relations(file: str):
     List relations in the input program.
     """
 
-    souffle_ast = souffle.parse(file, use_transformed=True)
-
-    relvisitor = RelationVisitor()
-    relvisitor.visit(souffle_ast)
-
-    for rel in relvisitor.rels.values():
+    for rel in _context(file).rels.values():
         print(rel)
 
 
@@ -45,14 +47,10 @@ def indexes(file: str):
     The list is conservative (i.e. some indexes may not be included)
     """
 
-    souffle_ast = souffle.parse(file, use_transformed=True)
-    ram_ast = ram.parse(file)
-
-    relvisitor = RelationVisitor()
-    relvisitor.visit(souffle_ast)
+    ctx = _context(file)
 
-    index_visitor = IndexVisitor(rels=relvisitor.rels)
-    index_visitor.visit(ram_ast)
+    index_visitor = IndexVisitor(rels=ctx.rels)
+    index_visitor.visit(ctx.ram_ast)
 
     print("WARNING: This list is conservative. Some indexes may not be included.")
     for relname, indexes in index_visitor.indexes.items():
@@ -67,17 +65,22 @@ def explain(file: str):
     Generate a (non-functional) Python-like program from the compiler's RAM representation.
     """
 
-    souffle_ast = souffle.parse(file, use_transformed=True)
-    ram_ast = ram.parse(file)
+    ctx = _context(file)
 
-    relvisitor = RelationVisitor()
-    relvisitor.visit(souffle_ast)
+    plan_visitor = PyPlanVisitor(rels=ctx.rels)
+    print(plan_visitor.visit(ctx.ram_ast))
 
-    simplifier = RAMSimplifier()
-    simplified_ram_ast = simplifier.transform(ram_ast)
 
-    plan_visitor = PyPlanVisitor(rels=relvisitor.rels)
-    print(plan_visitor.visit(simplified_ram_ast))
+@app.command()
+def report(file: str):
+    """
+    List indexes, then explain the Souffle program passed as arg.
+
+    Both share the same context, so the compiler runs once per output (transformed Datalog, then RAM) and relations are only collected once.
+    """
+
+    indexes(file)
+    explain(file)
 
 
 app()
@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict
+
+import lark.tree
+
+from .parsers import ram, souffle
+from .visitors.relations import Relation, RelationVisitor
+
+
+@dataclass
+class SouffleCtx:
+    """
+    Everything derived from a single Souffle program, computed lazily and at most once.
+
+    This lets several commands share the parses and the relation walk.
+    """
+
+    fname: str
+
+    @cached_property
+    def souffle_ast(self) -> lark.tree.Tree:
+        return souffle.parse(self.fname, use_transformed=True)
+
+    @cached_property
+    def ram_ast(self) -> lark.tree.Tree:
+        return ram.parse(self.fname)
+
+    @cached_property
+    def rels(self) -> Dict[str, Relation]:
+        relvisitor = RelationVisitor()
+        relvisitor.visit(self.souffle_ast)
+        return relvisitor.rels
@@ -1,38 +1,57 @@
+import functools
 import os
+import subprocess
 
 from lark import Lark
+import lark_cython
 import lark.tree
 
 from . import GRAMMARS_DIR
 from .souffle import SouffleError
 
-
 RAM_GRAMMAR_FILE = os.path.join(GRAMMARS_DIR, "ram.lark")
 
 
-_parser: Lark
-with open(RAM_GRAMMAR_FILE, "r") as fl:
-    _parser = Lark(fl, start="program")
+# NOTE: cache=True stores the LALR tables in the temp dir, keyed on the grammar and Lark version.
+_parser = Lark.open(
+    RAM_GRAMMAR_FILE,
+    start="program",
+    parser="lalr",
+    lexer="contextual",
+    cache=True,
+    _plugins=lark_cython.plugins,
+)
 
 
 def parse(fname: str, use_transformed: bool = True) -> lark.tree.Tree:
     """
     Parse a single source file, then return list of relevant entities in the file.
+
+    Results are cached per file, so the returned tree is shared and must not be modified.
     """
+    return _parse(os.path.abspath(fname), use_transformed)
+
 
+@functools.lru_cache(maxsize=8)
+def _parse(fname: str, use_transformed: bool) -> lark.tree.Tree:
     dirname, fname = os.path.dirname(fname), os.path.basename(fname)
-    dirname = dirname or "."
 
     ram_version = "transformed" if use_transformed else "initial"
-    souffle = os.popen(
-        f"sh -c 'cd {dirname} && souffle --show={ram_version}-ram {fname}'",
-        "r",
-    )
-    src = souffle.read()
+    try:
+        souffle = subprocess.run(
+            ["souffle", f"--show={ram_version}-ram", fname],
+            cwd=dirname,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+    except FileNotFoundError as e:
+        raise SouffleError(
+            f"Souffle process failed on source file {fname}: {e.filename} not found"
+        ) from e
 
-    if ecode := souffle.close():
+    if ecode := souffle.returncode:
         raise SouffleError(
             f"Souffle process failed on source file {fname}: exit code {ecode}"
         )
 
-    return _parser.parse(src)
+    return _parser.parse(souffle.stdout)
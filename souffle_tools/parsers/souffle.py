@@ -1,6 +1,9 @@
+import functools
 import os
+import subprocess
 
 from lark import Lark
+import lark_cython
 import lark.tree
 
 from . import GRAMMARS_DIR
@@ -16,39 +19,65 @@ class SouffleError(RuntimeError):
     ...
 
 
-_parser: Lark
-with open(SOUFFLE_GRAMMAR_FILE, "r") as fl:
-    _parser = Lark(fl, start="program")
+_parser = Lark.open(
+    SOUFFLE_GRAMMAR_FILE,
+    start="program",
+    parser="lalr",
+    lexer="contextual",
+    cache=True,
+    _plugins=lark_cython.plugins,
+)
 
 
 def parse(fname: str, use_transformed: bool = False) -> lark.tree.Tree:
     """
     Parse a single source file, then return list of relevant entities in the file.
+
+    Trees are memoized on the absolute path and shared between callers: don't modify them.
     """
+    return _parse(os.path.abspath(fname), use_transformed)
+
 
+@functools.lru_cache(maxsize=8)
+def _parse(fname: str, use_transformed: bool) -> lark.tree.Tree:
     dirname, fname = os.path.dirname(fname), os.path.basename(fname)
-    dirname = dirname or "."
 
-    src: str
     if use_transformed:
-        souffle = os.popen(
-            f"sh -c 'cd {dirname} && souffle --show=transformed-datalog {fname}'",
-            "r",
-        )
-        src = souffle.read()
+        try:
+            souffle = subprocess.run(
+                ["souffle", "--show=transformed-datalog", fname],
+                cwd=dirname,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+        except FileNotFoundError as e:
+            raise SouffleError(
+                f"Souffle process failed on source file {fname}: {e.filename} not found"
+            ) from e
 
-        if (ecode := souffle.close()) == 0:
+        if ecode := souffle.returncode:
             raise SouffleError(
                 f"Souffle process failed on source file {fname}: exit code {ecode}"
             )
 
+        return _parser.parse(souffle.stdout)
+
     else:
-        preprocessor = os.popen(f"sh -c 'cd {dirname} && cpp {fname} -o -'", "r")
-        src = preprocessor.read()
+        try:
+            preprocessor = subprocess.run(
+                ["cpp", fname, "-o", "-"],
+                cwd=dirname,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+        except FileNotFoundError as e:
+            raise PreprocessorError(
+                f"C preprocessor failed on source file {fname}: {e.filename} not found"
+            ) from e
 
-        if (ecode := preprocessor.close()) == 0:
+        if ecode := preprocessor.returncode:
             raise PreprocessorError(
                 f"C preprocessor failed on source file {fname}: exit code {ecode}"
             )
 
-    return _parser.parse(src)
+        return _parser.parse(preprocessor.stdout)
@@ -0,0 +1,48 @@
+# cython: language_level=3
+"""
+Compiled version of PlanNode._emit, used by ram_plan.py when it is built (see setup.py).
+"""
+
+cdef list _INDENT_CACHE = [""]
+
+
+cdef str _indent(Py_ssize_t depth):
+    while len(_INDENT_CACHE) <= depth:
+        _INDENT_CACHE.append(_INDENT_CACHE[-1] + "   ")
+    return _INDENT_CACHE[depth]
+
+
+cpdef void emit(object node, object write, Py_ssize_t depth, bint debug, str prefix="") except *:
+    """
+    Write the lines of a PlanNode, without a trailing newline.
+    """
+    cdef str indent = prefix + _indent(depth) if prefix else _indent(depth)
+    cdef list children = node.children
+    cdef object trailer = node.trailer
+    cdef object debug_info
+    cdef str seperator
+    cdef Py_ssize_t i
+
+    if debug:
+        debug_info = node.debug_info
+        if debug_info:
+            debug_info = debug_info.replace("\n", f"\n{indent}")
+            write(
+                f"{indent}---------------\n{indent}{debug_info}\n{indent}---------------\n"
+            )
+
+    write(indent)
+    write(node.text)
+
+    if children or trailer is not None:
+        write("\n")
+
+    if children:
+        seperator = f"{node.seperator}\n"
+        for i in range(len(children)):
+            if i > 0:
+                write(seperator)
+            emit(children[i], write, depth + 1, debug, prefix)
+
+    if trailer is not None:
+        write(f"\n{indent}{trailer}")
@@ -1,15 +1,13 @@
 from collections import defaultdict
-from collections.abc import Iterable
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from lark.visitors import Interpreter
 
-from .utils import has_child, children_by_name
 from .relations import Relation
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SouffleBTreeIndex:
     relname: str
     attrs: List[Tuple[str, str]]
@@ -27,45 +25,48 @@ class SouffleBTreeIndex:
 
 class IndexVisitor(Interpreter):
     def __init__(self, rels: Dict[str, Relation]):
-        self.indexes = defaultdict(lambda: [])
+        self.indexes: Dict[str, List[SouffleBTreeIndex]] = defaultdict(lambda: [])
         self.rels = rels
-        self._tuple_name = None
-        self._tuple_attrs = set()
+        self._tuple_name: Optional[str] = None
+        self._tuple_attrs = 0  # bitmap of the tuple's attributes in the ram_cond.
 
     def _add_index(self, tuple_name, relname, on_index):
         # track this tuple in the ram_cond
         self._tuple_name = tuple_name
 
-        assert isinstance(self._tuple_attrs, Iterable)
         assert relname in self.rels
 
         # visit index condition to gather attributes in the index.
         self.visit(on_index)
-        attrs = list(
-            map(self.rels[relname].attrs.__getitem__, sorted(self._tuple_attrs))
-        )
+
+        # read off the set bits in ascending order.
+        rel_attrs = self.rels[relname].attrs
+        attrs = []
+        bitmap = self._tuple_attrs
+        while bitmap:
+            attrs.append(rel_attrs[(bitmap & -bitmap).bit_length() - 1])
+            bitmap &= bitmap - 1
 
         self.indexes[relname].append(SouffleBTreeIndex(relname, attrs))
 
         # reset tuple_name. NOTE: Can I use context managers here?
         self._tuple_name = None
-        self._tuple_attrs = set()
+        self._tuple_attrs = 0
 
     def forloop(self, tree):
-        if has_child(tree, "on_index"):
+        # NOTE: on_index is an optional placeholder, so it is always the third child.
+        on_index = tree.children[2]
+        if on_index is not None:
             tuple_name = str(tree.children[0])
             relname = self.visit(tree.children[1])
-            on_index = tree.children[2]
             self._add_index(tuple_name, relname, on_index)
 
         self.visit(tree.children[-1])
 
     def tuple_element_ref(self, tree):
-        if self._tuple_name == str(tree.children[0]):
-            self._tuple_attrs.add(int(tree.children[1]))
+        children = tree.children
+        if self._tuple_name == str(children[0]):
+            self._tuple_attrs |= 1 << int(children[1].value)
 
     def ram_relname(self, tree) -> str:
-        return self.visit(next(children_by_name(tree, "qualified_name")))
-
-    def qualified_name(self, tree) -> str:
-        return ".".join(map(str, tree.children))
+        return str(tree.children[-1])
@@ -1,43 +1,75 @@
 from collections.abc import Mapping
-from typing import Dict, List
+from typing import Callable, Dict, List
 
 import lark.tree
-import lark.lexer
 from lark.visitors import Interpreter
 
-from .utils import has_child
+from .utils import rule_handlers, stratum_number, unescape_string
 from .relations import Relation
 
+# an atomic condition has the highest precedence, we don't need to bracket it.
+_ATOMIC_CONDS = frozenset(
+    ["in_cond", "exists_cond", "isempty_cond", "comparision", "bracketed_cond"]
+)
+
+# conditions that can be unbracketed in each position.
+_NOT_LEVEL_CONDS = frozenset(["not_cond"])
+_AND_LEVEL_CONDS = _NOT_LEVEL_CONDS | {"and_cond"}
+_OR_LEVEL_CONDS = _AND_LEVEL_CONDS | {"or_cond"}
+_ANY_LEVEL_CONDS = _OR_LEVEL_CONDS | {"ram_cond"}
+
+_NEGATED_COMPARATORS = {"=": "!=", "!=": "="}
+
 
 class PyPlanVisitor(Interpreter):
     """
     Converts the RAM program from the compiler into a (non-functional) Python program.
 
     This gives us syntax highlighting and some other nice editor features for viewing the plan.
+
+    Rule methods take the rule's children as arguments. They are visited top down,
+    as the tuples bound by for loops are needed to resolve the references below them.
     """
 
     INDENT_GROUP = "   "
 
     def __init__(self, rels: Dict[str, Relation]):
-        self.out = ""
         self.rels = rels
-        self._bound_tuples = {}
+        self._bound_tuples: Dict[str, Relation] = {}
+        self._handlers = rule_handlers(self)
+
+    def visit(self, tree):
+        handler = self._handlers.get(tree.data)
+        if handler is None:
+            return [
+                self.visit(child)
+                for child in tree.children
+                if isinstance(child, lark.tree.Tree)
+            ]
+        # NOTE: rule methods take their children inline.
+        return handler(*tree.children)
 
     @classmethod
-    def _stringify_plan(cls, plan: Dict, prefix: str = "") -> str:
-        def stringify(c: Dict | str):
-            if isinstance(c, Mapping):
-                return cls._stringify_plan(c, prefix=cls.INDENT_GROUP + prefix)
-            else:
-                return cls.INDENT_GROUP + prefix + str(c)
-
-        res: str
+    def _stringify_plan(
+        cls, plan: Mapping, write: Callable[[str], None], prefix: str = ""
+    ) -> None:
         if isinstance(plan["l"], str):
-            res = prefix + plan["l"]
+            write(prefix + plan["l"])
         else:
-            res = "\n".join(map(prefix.__add__, plan["l"]))
-
-        return res + "\n" + "\n".join(map(stringify, plan["c"]))
+            for i, line in enumerate(plan["l"]):
+                if i > 0:
+                    write("\n")
+                write(prefix + line)
+        write("\n")
+
+        child_prefix = cls.INDENT_GROUP + prefix
+        for i, c in enumerate(plan["c"]):
+            if i > 0:
+                write("\n")
+            if isinstance(c, dict):
+                cls._stringify_plan(c, write, prefix=child_prefix)
+            else:
+                write(child_prefix + str(c))
 
     def _safe_prepend(self, prefix: List[str] | str, ls: List[str] | str) -> List[str]:
         if isinstance(ls, str):
@@ -46,44 +78,84 @@ class PyPlanVisitor(Interpreter):
             prefix = [prefix]
         return prefix + ls
 
-    def _safe_visit(self, tree: lark.tree.Tree | lark.lexer.Token):
-        if isinstance(tree, lark.tree.Tree):
-            return self.visit(tree)
-        else:
-            return str(tree)
-
-    def program(self, tree) -> str:
-        def extract_stratum_number(subroutine_node: lark.tree.Tree) -> int:
-            # bit of a HACK: depends on stratum names used by the souffle compiler.
-            return int(str(subroutine_node.children[0]).split("_")[1])
+    ### Condition simplification
+    # By default the RAM generated by the compiler has lots of redundant brackets, etc.
+    # These are dropped while visiting, rather than rewriting the tree first.
 
-        tree.children[1:-1] = sorted(tree.children[1:-1], key=extract_stratum_number)
-        return "\n".join(
-            map(self._stringify_plan, map(self.visit, tree.children[1:-1]))
-        )
+    @classmethod
+    def _cond_kind(cls, tree: lark.tree.Tree) -> str:
+        """
+        The kind of condition tree is, once redundant brackets and negations are removed.
+        """
+        if tree.data == "bracketed_cond":
+            kind = cls._cond_kind(tree.children[0])
+            return kind if kind in _ATOMIC_CONDS else "bracketed_cond"
+        elif tree.data == "not_cond":
+            subcond = tree.children[0]
+            if (
+                cls._cond_kind(subcond) == "comparision"
+                and cls._comparision(subcond)[1] in _NEGATED_COMPARATORS
+            ):
+                return "comparision"
+        return tree.data
 
-    def subroutine(self, tree) -> Dict:
-        stratum_name = str(tree.children[0])
+    @classmethod
+    def _comparision(cls, tree: lark.tree.Tree) -> tuple[lark.tree.Tree, str]:
+        """
+        Find the comparision a condition of kind comparision boils down to, along with its comparator.
+        """
+        if tree.data == "bracketed_cond":
+            return cls._comparision(tree.children[0])
+        elif tree.data == "not_cond":
+            comparision, comparator = cls._comparision(tree.children[0])
+            return comparision, _NEGATED_COMPARATORS[comparator]
+        return tree, str(tree.children[1])
+
+    def _visit_cond(self, tree: lark.tree.Tree, unbracketed: frozenset) -> str:
+        """
+        Visit a condition, dropping its brackets if the condition inside has one of the unbracketed kinds.
+        """
+        if self._cond_kind(tree) == "bracketed_cond":
+            subcond = tree.children[0]
+            while subcond.data == "bracketed_cond":
+                subcond = subcond.children[0]
+
+            if subcond.data in unbracketed:
+                return self.visit(subcond)
+
+        return self.visit(tree)
+
+    def program(self, _declaration, *subroutines) -> str:
+        # NOTE: the tree is shared with other parses, so we can't sort it in place.
+        strata = sorted(subroutines[:-1], key=stratum_number)
+
+        out: List[str] = []
+        for i, subroutine in enumerate(strata):
+            if i > 0:
+                out.append("\n")
+            self._stringify_plan(self.visit(subroutine), out.append)
+        return "".join(out)
+
+    def subroutine(self, stratum_name, *stmts) -> Dict:
+        visit = self.visit
         return {
             "l": f"def {stratum_name}():",
-            "c": list(map(self.visit, tree.children[1:])),
+            "c": [visit(stmt) for stmt in stmts],
         }
 
     ### Subroutine statements
 
-    def loop_stmt(self, tree) -> Dict:
-        return {"l": f"while True:", "c": list(map(self.visit, tree.children[1:]))}
+    def loop_stmt(self, *stmts) -> Dict:
+        visit = self.visit
+        return {"l": f"while True:", "c": [visit(stmt) for stmt in stmts]}
 
-    def query_stmt(self, tree) -> Dict:
-        return self.visit(tree.children[0])
+    def query_stmt(self, stmt) -> Dict:
+        return self.visit(stmt)
 
-    def debug_stmt(self, tree) -> Dict:
-        # HACK: We need to do this because of the weird debug string format.
-        res = {}
-        exec(f"x = {str(tree.children[0])}", {}, res)
-        debug_info = ['"""'] + res["x"].split("\n") + ['"""']
+    def debug_stmt(self, debug_str, query_stmt) -> Dict:
+        debug_info = ['"""'] + unescape_string(debug_str).split("\n") + ['"""']
 
-        plan = self.visit(tree.children[1])
+        plan = self.visit(query_stmt)
         if isinstance(plan, str):
             debug_info.append(plan)
             return {"l": debug_info, "c": []}
@@ -91,82 +163,93 @@ class PyPlanVisitor(Interpreter):
             plan["l"] = self._safe_prepend(debug_info, plan["l"])
             return plan
 
-    def clear_stmt(self, tree) -> str:
-        return f"{self.visit(tree.children[0])} = set()"
+    def clear_stmt(self, ram_relname) -> str:
+        return f"{self.visit(ram_relname)} = set()"
 
-    def swap_stmt(self, tree) -> str:
-        rel1, rel2 = self.visit_children(tree)
-        return f"swap({rel1}, {rel2})"
+    def swap_stmt(self, rel1, rel2) -> str:
+        return f"swap({self.visit(rel1)}, {self.visit(rel2)})"
 
-    def exit_stmt(self, tree) -> str:
-        return f"if {self.visit(tree.children[0])}: break"
+    def exit_stmt(self, cond) -> str:
+        return f"if {self._visit_cond(cond, _ANY_LEVEL_CONDS)}: break"
 
-    def io_stmt(self, tree) -> str:
-        relname = self.visit(tree.children[0])
-        io_options = dict(map(self.visit, tree.children[1:]))
+    def io_stmt(self, relname, *io_options) -> str:
+        relname = str(relname)
+
+        # NOTE: only these options show up in the plan.
+        io_operation = None
+        filename = relname
+        delimiter = "\t"
+        visit = self.visit
+        for io_option in io_options:
+            name, value = visit(io_option)
+            if name == "operation":
+                io_operation = value
+            elif name == "filename":
+                filename = value
+            elif name == "delimiter":
+                delimiter = value
 
         operation: str
-        if io_options["operation"] == "input":
+        if io_operation == "input":
             operation = "input"
-        elif io_options["operation"] == "output":
+        elif io_operation == "output":
             operation = "output"
         else:
-            raise RuntimeError(f"Unrecognized IO operation {io_options['operation']}")
+            raise RuntimeError(f"Unrecognized IO operation {io_operation}")
 
         fname = ""
-        if io_options.get("filename", relname).removesuffix(".dl") != relname:
-            fname = f", filename={io_options['filename']}"
+        if filename.removesuffix(".dl") != relname:
+            fname = f", filename={filename!r}"
 
-        delim = repr(io_options.get("delimiter", "\t"))
+        delim = repr(delimiter)
 
         return f"{operation}({relname}, delim={delim}{fname})"
 
     ### RAM statements
 
-    def declare_stmt(self, tree) -> Dict:
-        tuple_element_ref = self.visit(tree.children[0])
-        aggregator = str(tree.children[1])
-        tuple_name = str(tree.children[2])
-        ram_relname = self.visit(tree.children[3])
+    def declare_stmt(
+        self, tuple_element_ref, aggregator, tuple_name, ram_relname, stmt
+    ) -> Dict:
+        tuple_element_ref = self.visit(tuple_element_ref)
+        ram_relname = self.visit(ram_relname)
 
         return {
             "l": f"{tuple_element_ref} = {aggregator}({tuple_name} for {tuple_name} in {ram_relname})",
-            "c": [self.visit(tree.children[-1])],
+            "c": [self.visit(stmt)],
         }
 
-    def forloop(self, tree) -> Dict:
-        tuple_name = str(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
-
-        relname = self.visit(tree.children[1].children[-1])
+    def forloop(self, tuple_name, ram_relname, on_index, stmt) -> Dict:
+        tuple_name = str(tuple_name)
+        relname = str(ram_relname.children[-1])
+        ram_relname = self.visit(ram_relname)
 
         # NOTE: again this is something where we might want to use context managers.
         self._bound_tuples[tuple_name] = self.rels[relname]
 
-        if has_child(tree, "on_index"):
-            ram_relname = f"index_scan({ram_relname}, lambda {tuple_name}: {self.visit(tree.children[2])})"
+        if on_index is not None:
+            ram_relname = f"index_scan({ram_relname}, lambda {tuple_name}: {self.visit(on_index)})"
 
         res = {
             "l": f"for {tuple_name} in {ram_relname}:",
-            "c": [self.visit(tree.children[-1])],
+            "c": [self.visit(stmt)],
         }
 
         # we're exiting the scope where this tuple_name is valid.
         del self._bound_tuples[tuple_name]
         return res
 
-    def if_stmt(self, tree) -> Dict | str:
-        if_cond = f"if {self.visit(tree.children[0])}"
+    def if_stmt(self, cond, on_index, brk, stmt) -> Dict | str:
+        if_cond = f"if {self._visit_cond(cond, _ANY_LEVEL_CONDS)}"
 
         # add index condition, if there is one.
-        if has_child(tree, "on_index"):
-            if_cond += f" and index_cond(lambda : {self.visit(tree.children[1])})"
+        if on_index is not None:
+            if_cond += f" and index_cond(lambda : {self.visit(on_index)})"
 
         if_cond += ":"
 
-        plan = self.visit(tree.children[-1])
+        plan = self.visit(stmt)
 
-        if has_child(tree, "BREAK"):
+        if brk is not None:
             if_cond += " break"
             if isinstance(plan, str):
                 return {"l": self._safe_prepend(if_cond, plan), "c": []}
@@ -176,12 +259,11 @@ class PyPlanVisitor(Interpreter):
         else:
             return {"l": if_cond, "c": [plan]}
 
-    def unpack_stmt(self, tree) -> Dict:
+    def unpack_stmt(self, iden, _arity, tuple_element_ref, stmt) -> Dict:
         # TODO: Ideally we resolve ADT types here.
-        iden = str(tree.children[0])
-        tuple_element_ref = self.visit(tree.children[2])
+        tuple_element_ref = self.visit(tuple_element_ref)
 
-        plan = self.visit(tree.children[-1])
+        plan = self.visit(stmt)
 
         text = f"{iden} = {tuple_element_ref}"
 
@@ -191,124 +273,121 @@ class PyPlanVisitor(Interpreter):
             plan["l"] = self._safe_prepend(text, plan["l"])
             return plan
 
-    def insert_stmt(self, tree) -> str:
-        tuple_expr = self.visit(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
+    def insert_stmt(self, tuple_expr, ram_relname) -> str:
+        return f"{self.visit(ram_relname)}.add({self.visit(tuple_expr)})"
 
-        return f"{ram_relname}.add({tuple_expr})"
+    def erase_stmt(self, tuple_expr, ram_relname) -> str:
+        return f"{self.visit(ram_relname)}.remove({self.visit(tuple_expr)})"
 
-    def erase_stmt(self, tree) -> str:
-        tuple_expr = self.visit(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
-
-        return f"{ram_relname}.remove({tuple_expr})"
-
-    def on_index(self, tree):
-        return self.visit(tree.children[0])
+    def on_index(self, cond):
+        return self._visit_cond(cond, _ANY_LEVEL_CONDS)
 
     ### RAM conditions
 
-    def ram_cond(self, tree):
-        def is_complex(tree: lark.tree.Tree):
-            return len(tree.children) > 0
+    def ram_cond(self, *conds):
+        # NOTE: the grammar only allows conditions here, and these always have children.
+        visit = self.visit
+        return " and ".join([f"({visit(cond)})" for cond in conds])
 
-        def bracket_complex(tree: lark.tree.Tree | lark.lexer.Token):
-            if isinstance(tree, lark.tree.Tree):
-                if is_complex(tree):
-                    return f"({self.visit(tree)})"
-                else:
-                    return self.visit(tree)
-            else:
-                return str(tree)
-
-        return " and ".join(map(bracket_complex, tree.children))
+    def or_cond(self, lop, rop):
+        return (
+            self._visit_cond(lop, _OR_LEVEL_CONDS)
+            + " or "
+            + self._visit_cond(rop, _AND_LEVEL_CONDS)
+        )
 
-    def or_cond(self, tree):
-        return " or ".join(self.visit_children(tree))
+    def and_cond(self, lop, rop):
+        return (
+            self._visit_cond(lop, _AND_LEVEL_CONDS)
+            + " and "
+            + self._visit_cond(rop, _NOT_LEVEL_CONDS)
+        )
 
-    def and_cond(self, tree):
-        return " and ".join(self.visit_children(tree))
+    def not_cond(self, subcond):
+        if self._cond_kind(subcond) == "comparision":
+            comparision, comparator = self._comparision(subcond)
+            if comparator in _NEGATED_COMPARATORS:
+                # negating (in)equalities just flips the comparator.
+                return self._visit_comparision(
+                    comparision.children[0],
+                    _NEGATED_COMPARATORS[comparator],
+                    comparision.children[2],
+                )
+        return "not " + self.visit(subcond)
 
-    def not_cond(self, tree):
-        return "not " + self.visit(tree.children[0])
+    def in_cond(self, tuple_expr, ram_relname):
+        return self.visit(tuple_expr) + " in " + self.visit(ram_relname)
 
-    def in_cond(self, tree):
-        return " in ".join(self.visit_children(tree))
+    def exists_cond(self, tuple_name, ram_relname):
+        return f"exists({tuple_name} in {self.visit(ram_relname)})"
 
-    def exists_cond(self, tree):
-        return (
-            "exists("
-            + str(tree.children[0])
-            + " in "
-            + self.visit(tree.children[1])
-            + ")"
-        )
+    def isempty_cond(self, ram_relname):
+        return self.visit(ram_relname) + " == set()"
 
-    def isempty_cond(self, tree):
-        return self.visit(tree.children[0]) + " == set()"
+    def comparision(self, lop, comparator, rop):
+        return self._visit_comparision(lop, str(comparator), rop)
 
-    def comparision(self, tree):
-        comparator = str(tree.children[1])
+    def _visit_comparision(self, lop, comparator: str, rop) -> str:
         if comparator == "=":
             comparator = "=="
-        return (
-            self.visit(tree.children[0])
-            + f" {comparator} "
-            + self.visit(tree.children[2])
-        )
+        return self.visit(lop) + f" {comparator} " + self.visit(rop)
 
-    def bracketed_cond(self, tree):
-        return f"({self.visit(tree.children[0])})"
+    def bracketed_cond(self, subcond):
+        if self._cond_kind(subcond) in _ATOMIC_CONDS:
+            return self.visit(subcond)
+        return f"({self.visit(subcond)})"
 
-    def tuple_expr(self, tree):
-        return f"({','.join(self.visit_children(tree))})"
+    def tuple_expr(self, *elements):
+        visit = self.visit
+        return f"({','.join([visit(element) for element in elements])})"
 
-    def add_tuple_element(self, tree):
-        return " + ".join(self.visit_children(tree))
+    def add_tuple_element(self, lop, rop):
+        return self.visit(lop) + " + " + self.visit(rop)
 
-    def sub_tuple_element(self, tree):
-        return " - ".join(self.visit_children(tree))
+    def sub_tuple_element(self, lop, rop):
+        return self.visit(lop) + " - " + self.visit(rop)
 
     def undef(self, _):
         return "_"
 
-    def tuple_element_literal(self, tree):
-        return str(tree.children[0])
+    def tuple_element_literal(self, literal):
+        return str(literal)
 
-    def tuple_element_ref(self, tree):
-        tuple_name = str(tree.children[0])
+    def tuple_element_ref(self, tuple_name, colname):
+        tuple_name = str(tuple_name)
 
-        colname = str(tree.children[1])
-        if tuple_name in self._bound_tuples:
-            # NOTE: We need this check because tuple_element_ref can also be used for indexing into types.
-            colname = self._bound_tuples[tuple_name].attrs[int(colname)][0]
+        colname = str(colname)
+        # NOTE: We need this check because tuple_element_ref can also be used for indexing into types.
+        rel = self._bound_tuples.get(tuple_name)
+        if rel is not None:
+            colname = rel.col_names[int(colname)]
         else:
             colname = f"_{colname}"
 
-        return ".".join([tuple_name, colname])
+        return f"{tuple_name}.{colname}"
 
-    def functor_call(self, tree):
-        return (
-            self._safe_visit(tree.children[0])
-            + "("
-            + ",".join(map(self.visit, tree.children[1:]))
-            + ")"
-        )
+    def functor_call(self, functor, *args):
+        visit = self.visit
+        return visit(functor) + "(" + ",".join([visit(arg) for arg in args]) + ")"
+
+    def userdef_functor(self, name):
+        return f"__functor_{name}"
 
-    def userdef_functor(self, tree):
-        return "__functor_" + self.visit(tree.children[0])
+    def intrinsic_functor(self, name):
+        return str(name)
 
-    def bracketed_tuple_element(self, tree):
-        return f"({self.visit(tree.children[0])})"
+    def bracketed_tuple_element(self, element):
+        return f"({self.visit(element)})"
 
-    def record_tuple_element(self, tree):
-        return "[" + ",".join(self.visit_children(tree)) + "]"
+    def record_tuple_element(self, *elements):
+        visit = self.visit
+        return "[" + ",".join([visit(element) for element in elements]) + "]"
 
-    def ram_relname(self, tree):
-        relname = self.visit(tree.children[-1])
+    def ram_relname(self, relkind, relname):
+        relname = str(relname)
         prefix = ""
-        if len(tree.children) > 1:
-            relkind = str(tree.children[0])
+        if relkind is not None:
+            relkind = str(relkind)
 
             if relkind == "@new_":
                 prefix = "__new_"
@@ -322,35 +401,5 @@ class PyPlanVisitor(Interpreter):
 
     ### Building blocks
 
-    def io_option(self, tree):
-        return self.visit_children(tree)
-
-    def tab_list(self, tree):
-        return "\t".join(map(str, tree.children))
-
-    def qualified_name(self, tree):
-        return ".".join(map(str, tree.children))
-
-    def object(self, tree):
-        return dict(map(self.visit, tree.children))
-
-    def array(self, tree):
-        return list(map(self.visit, tree.children))
-
-    def pair(self, tree):
-        return (str(tree.children[0]), self.visit(tree.children[1]))
-
-    def string(self, tree):
-        return str(tree.children[0])
-
-    def number(self, tree):
-        return int(tree.children[0])
-
-    def true(self, _):
-        return True
-
-    def false(self, _):
-        return False
-
-    def null(self, _):
-        return None
+    def io_option(self, name, value):
+        return (str(name), unescape_string(value))
@@ -1,15 +1,42 @@
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from functools import partial
+from typing import Callable, Dict, List, Optional, TextIO, Tuple
 
-import lark.tree
-import lark.lexer
+from lark.tree import Tree
 from lark.visitors import Interpreter
 
-from .utils import has_child
+from .utils import rule_handlers, stratum_number, unescape_string
 from .relations import Relation
 
+try:
+    from ._plan_emit import emit as _compiled_emit  # type: ignore
+except ImportError:
+    # NOTE: the compiled emitter is optional, see setup.py.
+    _compiled_emit = None
 
-@dataclass
+
+_INDENT_CACHE = [""]
+
+# rules that just join their visited children.
+_JOINED_RULES = {
+    "or_cond": "; ",
+    "and_cond": ", ",
+    "in_cond": " ∈ ",
+    "add_tuple_element": " + ",
+    "sub_tuple_element": " - ",
+}
+
+
+def _indent(depth: int) -> str:
+    """
+    Indentation for a plan node at the given depth, built once per depth.
+    """
+    while len(_INDENT_CACHE) <= depth:
+        _INDENT_CACHE.append(_INDENT_CACHE[-1] + "   ")
+    return _INDENT_CACHE[depth]
+
+
+@dataclass(slots=True)
 class PlanNode:
     text: str
     children: List["PlanNode"]
@@ -18,304 +45,344 @@ class PlanNode:
     trailer: Optional[str] = None
 
     def __str__(self, prefix="", debug: bool = False) -> str:
-        debug_info = ""
+        buf: List[str] = []
+        self._write(buf.append, debug, prefix)
+        return "".join(buf)
+
+    def write_to(self, fp: TextIO, prefix="", debug: bool = False) -> None:
+        """
+        Write the plan to fp as it is generated, rather than building it as one string.
+        """
+        self._write(fp.write, debug, prefix)
+
+    def _write(self, write: Callable[[str], object], debug: bool, prefix: str) -> None:
+        if _compiled_emit is not None:
+            _compiled_emit(self, write, 0, debug, prefix)
+        else:
+            self._emit(write, 0, debug, prefix)
+
+        # a leaf's line is only terminated by its parent.
+        if not self.children and self.trailer is None:
+            write("\n")
+
+    def _emit(
+        self, write: Callable[[str], object], depth: int, debug: bool, prefix: str = ""
+    ) -> None:
+        """
+        Write this node's lines, without a trailing newline.
+        """
+        indent = prefix + _indent(depth) if prefix else _indent(depth)
+
         if debug and self.debug_info:
-            # HACK: We need to do this because of the weird format used by the souffle compiler.
-            res = {}
-            exec(f"x = {self.debug_info}", {}, res)
-            debug_info = res["x"].replace("\n", f"\n{prefix}")
-            debug_info = f"{prefix}---------------\n{prefix}{debug_info}\n{prefix}---------------\n"
-
-        return (
-            debug_info
-            + prefix
-            + self.text
-            + "\n"
-            + f"{self.seperator}\n".join(
-                map(
-                    lambda x: x.__str__(
-                        prefix=prefix + "   ", debug=debug
-                    ).removesuffix("\n"),
-                    self.children,
-                )
+            debug_info = self.debug_info.replace("\n", f"\n{indent}")
+            write(
+                f"{indent}---------------\n{indent}{debug_info}\n{indent}---------------\n"
             )
-            + (f"\n{prefix}{self.trailer}" if self.trailer is not None else "")
-        )
 
+        write(indent)
+        write(self.text)
 
-class TextualPlanVisitor(Interpreter):
-    def __init__(self, rels: Dict[str, Relation]):
-        self.out = ""
-        self._plan = None  # for gradully building plans BOTTOM UP.
-        self.rels = rels
-        self._bound_tuples = {}
+        if self.children or self.trailer is not None:
+            write("\n")
 
-    def _safe_visit(self, tree: lark.tree.Tree | lark.lexer.Token):
-        if isinstance(tree, lark.tree.Tree):
-            return self.visit(tree)
-        else:
-            return str(tree)
+        for i, child in enumerate(self.children):
+            if i > 0:
+                write(f"{self.seperator}\n")
+            child._emit(write, depth + 1, debug, prefix)
 
-    def program(self, tree) -> PlanNode:
-        def extract_stratum_number(stratum_plan_node: PlanNode) -> int:
-            # bit of a HACK: depends on stratum names used by the souffle compiler.
-            return int(stratum_plan_node.text.split("_")[1])
+        if self.trailer is not None:
+            write(f"\n{indent}{self.trailer}")
 
-        return PlanNode(
-            "PROGRAM",
-            sorted(map(self.visit, tree.children[1:-1]), key=extract_stratum_number),
-        )
 
-    def subroutine(self, tree) -> PlanNode:
-        return PlanNode(
-            str(tree.children[0]),
-            list(map(self.visit, tree.children[1:])),
-            seperator=";",
-        )
+class TextualPlanVisitor(Interpreter):
+    def __init__(self, rels: Dict[str, Relation]):
+        self._plan = None  # for gradully building plans BOTTOM UP.
+        self.rels = rels
+        self._bound_tuples: Dict[str, Relation] = {}
+        # NOTE: plans keep referring to the same relations and columns, so cache their formatting.
+        self._relname_cache: Dict[Tuple[Optional[str], str], str] = {}
+        self._ref_cache: Dict[Tuple[str, str, int], str] = {}
+        self._handlers = rule_handlers(self)
+        for rule, sep in _JOINED_RULES.items():
+            self._handlers[rule] = partial(self._join, sep)
+
+    def visit(self, tree):
+        handler = self._handlers.get(tree.data)
+        if handler is None:
+            return [
+                self.visit(child) for child in tree.children if isinstance(child, Tree)
+            ]
+        # NOTE: rule methods take their children inline.
+        return handler(*tree.children)
+
+    def program(self, _declaration, *subroutines) -> PlanNode:
+        # NOTE: the caches are only valid for the relations of one program.
+        self._relname_cache.clear()
+        self._ref_cache.clear()
+
+        # NOTE: sort the subroutines by name before visiting them, so no plan node is parsed.
+        strata = sorted(subroutines[:-1], key=stratum_number)
+
+        visit = self.visit
+        return PlanNode("PROGRAM", [visit(subroutine) for subroutine in strata])
+
+    def subroutine(self, name, *stmts) -> PlanNode:
+        visit = self.visit
+        return PlanNode(str(name), [visit(stmt) for stmt in stmts], seperator=";")
 
     ### Subroutine statements
 
-    def loop_stmt(self, tree):
-        return PlanNode("FOR i ∈ ℕ", list(map(self.visit, tree.children[1:])))
+    def loop_stmt(self, *stmts):
+        visit = self.visit
+        return PlanNode("FOR i ∈ ℕ", [visit(stmt) for stmt in stmts])
 
-    def query_stmt(self, tree):
+    def query_stmt(self, stmt):
         # HACK: Things get non-local here. We expect the leaf that becomes root of self._plan to clean up after us.
         self._plan = PlanNode("", [])
-        return self.visit(tree.children[0])
+        return self.visit(stmt)
 
-    def debug_stmt(self, tree):
-        plan = self.visit(tree.children[1])
-        plan.debug_info = str(tree.children[0])
+    def debug_stmt(self, debug_str, query_stmt):
+        plan = self.visit(query_stmt)
+        plan.debug_info = unescape_string(debug_str)
         return plan
 
-    def clear_stmt(self, tree):
-        return PlanNode(f"{self.visit(tree.children[0])} = ∅", [])
+    def clear_stmt(self, ram_relname):
+        return PlanNode(f"{self.visit(ram_relname)} = ∅", [])
 
-    def swap_stmt(self, tree):
-        rel1, rel2 = self.visit_children(tree)
-        return PlanNode(f"SWAP {rel1}, {rel2}", [])
+    def swap_stmt(self, rel1, rel2):
+        return PlanNode(f"SWAP {self.visit(rel1)}, {self.visit(rel2)}", [])
 
-    def exit_stmt(self, tree):
-        return PlanNode(f"BREAK {self.visit(tree.children[0])}", [])
+    def exit_stmt(self, cond):
+        return PlanNode(f"BREAK {self.visit(cond)}", [])
 
-    def io_stmt(self, tree):
-        relname = self.visit(tree.children[0])
-        io_options = dict(map(self.visit, tree.children[1:]))
+    def io_stmt(self, relname, *io_options):
+        relname = str(relname)
+
+        # NOTE: only these options show up in the plan.
+        io_operation = None
+        filename = relname
+        delimiter = "\t"
+        visit = self.visit
+        for io_option in io_options:
+            name, value = visit(io_option)
+            if name == "operation":
+                io_operation = value
+            elif name == "filename":
+                filename = value
+            elif name == "delimiter":
+                delimiter = value
 
         operation: str
-        if io_options["operation"] == "input":
+        if io_operation == "input":
             operation = "INPUT FROM"
-        elif io_options["operation"] == "output":
+        elif io_operation == "output":
             operation = "OUTPUT TO"
         else:
-            raise RuntimeError(f"Unrecognized IO operation {io_options['operation']}")
+            raise RuntimeError(f"Unrecognized IO operation {io_operation}")
 
         fname = ""
-        if io_options.get("filename", relname).removesuffix(".dl") != relname:
-            fname = f" fname {io_options['filename']}"
+        if filename.removesuffix(".dl") != relname:
+            fname = f" fname {filename!r}"
 
-        delim = repr(io_options.get("delimiter", "\t"))
+        delim = repr(delimiter)
 
         return PlanNode(f"{operation} {relname} delim {delim}{fname}", [])
 
     ### RAM statements
 
-    def declare_stmt(self, tree):
-        assert self._plan is not None
+    def declare_stmt(
+        self, tuple_element_ref, aggregator, tuple_name, ram_relname, stmt
+    ):
+        query = self._plan
+        assert query is not None
+        visit = self.visit
 
-        tuple_element_ref = self.visit(tree.children[0])
-        aggregator = str(tree.children[1])
-        tuple_name = str(tree.children[2])
-        ram_relname = self.visit(tree.children[3])
+        tuple_element_ref = visit(tuple_element_ref)
+        ram_relname = visit(ram_relname)
 
-        self._plan.children.append(
+        query.children.append(
             PlanNode(
                 f"{tuple_element_ref} = {aggregator}{{{tuple_name} ∈ {ram_relname}}}",
                 [],
             )
         )
 
-        return self.visit(tree.children[-1])
+        return visit(stmt)
 
-    def forloop(self, tree):
-        assert self._plan is not None
-
-        tuple_name = str(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
+    def forloop(self, tuple_name, ram_relname, on_index, stmt):
+        query = self._plan
+        assert query is not None
+        visit = self.visit
+        bound_tuples = self._bound_tuples
 
-        relname = self.visit(tree.children[1].children[-1])
+        tuple_name = str(tuple_name)
+        relkind, relname = ram_relname.children
+        relname = str(relname)
+        # NOTE: reuses the relation name we already have, rather than visiting ram_relname.
+        ram_relname = self._cached_relname(relkind, relname)
 
         # NOTE: again this is something where we might want to use context managers.
-        self._bound_tuples[tuple_name] = self.rels[relname]
+        bound_tuples[tuple_name] = self.rels[relname]
 
         # add index condition, if there is one.
         cond = ""
-        if has_child(tree, "on_index"):
-            cond = f" if {self.visit(tree.children[2])}"
+        if on_index is not None:
+            cond = f" if {visit(on_index)}"
 
-        self._plan.children.append(
-            PlanNode(f"for {tuple_name} ∈ {ram_relname}{cond}", [])
-        )
+        query.children.append(PlanNode(f"for {tuple_name} ∈ {ram_relname}{cond}", []))
 
-        plan = self.visit(tree.children[-1])
+        plan = visit(stmt)
 
         # we're exiting the scope where this tuple_name is valid.
-        del self._bound_tuples[tuple_name]
+        del bound_tuples[tuple_name]
         return plan
 
-    def if_stmt(self, tree):
+    def if_stmt(self, cond, on_index, brk, stmt):
         assert self._plan is not None
 
         # TODO: We currently don't handle if statements that break
-        if not has_child(tree, "BREAK"):
-            if_cond = self.visit(tree.children[0])
+        if brk is None:
+            if_cond = self.visit(cond)
 
             # add index condition, if there is one.
             index_cond = ""
-            if has_child(tree, "on_index"):
-                index_cond = f" using index {self.visit(tree.children[1])}"
+            if on_index is not None:
+                index_cond = f" using index {self.visit(on_index)}"
 
             self._plan.children.append(PlanNode(f"if {if_cond}{index_cond}", []))
 
-        return self.visit(tree.children[-1])
+        return self.visit(stmt)
 
-    def unpack_stmt(self, tree):
+    def unpack_stmt(self, iden, _arity, tuple_element_ref, stmt):
         assert self._plan is not None
 
         # TODO: Ideally we resolve ADT types here.
-        iden = str(tree.children[0])
-        tuple_element_ref = self.visit(tree.children[2])
+        tuple_element_ref = self.visit(tuple_element_ref)
 
         self._plan.children.append(PlanNode(f"{iden} := {tuple_element_ref}", []))
 
-        return self.visit(tree.children[-1])
+        return self.visit(stmt)
 
-    def insert_stmt(self, tree):
-        assert self._plan is not None
-
-        tuple_expr = self.visit(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
+    def insert_stmt(self, tuple_expr, ram_relname):
+        plan = self._plan
+        assert plan is not None
+        visit = self.visit
 
-        self._plan.text = f"{ram_relname} ∪= {{{tuple_expr}"
-        self._plan.trailer = "}"
+        tuple_expr = visit(tuple_expr)
+        ram_relname = visit(ram_relname)
 
-        plan = self._plan
+        plan.text = f"{ram_relname} ∪= {{{tuple_expr}"
+        plan.trailer = "}"
 
         # ... and we don't need this: other part of the non-local HACK.
         self._plan = None
         return plan
 
-    def erase_stmt(self, tree):
-        assert self._plan is not None
-
-        tuple_expr = self.visit(tree.children[0])
-        ram_relname = self.visit(tree.children[1])
+    def erase_stmt(self, tuple_expr, ram_relname):
+        plan = self._plan
+        assert plan is not None
+        visit = self.visit
 
-        self._plan.text = f"{ram_relname} /= {{{tuple_expr}"
-        self._plan.trailer = "}"
+        tuple_expr = visit(tuple_expr)
+        ram_relname = visit(ram_relname)
 
-        plan = self._plan
+        plan.text = f"{ram_relname} /= {{{tuple_expr}"
+        plan.trailer = "}"
 
         # ... and we don't need this: other part of the non-local HACK.
         self._plan = None
         return plan
 
-    def on_index(self, tree):
-        return self.visit(tree.children[0])
+    def on_index(self, cond):
+        return self.visit(cond)
 
     ### RAM conditions
 
-    def ram_cond(self, tree):
-        def is_complex(tree: lark.tree.Tree):
-            return len(tree.children) > 0
-
-        def bracket_complex(tree: lark.tree.Tree | lark.lexer.Token):
-            if isinstance(tree, lark.tree.Tree):
-                if is_complex(tree):
-                    return f"({self.visit(tree)})"
-                else:
-                    return self.visit(tree)
-            else:
-                return str(tree)
-
-        return ", ".join(map(bracket_complex, tree.children))
-
-    def or_cond(self, tree):
-        return "; ".join(self.visit_children(tree))
-
-    def and_cond(self, tree):
-        return ", ".join(self.visit_children(tree))
+    def _join(self, sep: str, *children) -> str:
+        visit = self.visit
+        return sep.join([visit(child) for child in children])
 
-    def not_cond(self, tree):
-        return "!" + self.visit(tree.children[0])
+    def ram_cond(self, *conds):
+        # NOTE: the grammar only allows conditions here, and these always have children.
+        visit = self.visit
+        return ", ".join([f"({visit(cond)})" for cond in conds])
 
-    def in_cond(self, tree):
-        return " ∈ ".join(self.visit_children(tree))
+    def not_cond(self, subcond):
+        return "!" + self.visit(subcond)
 
-    def exists_cond(self, tree):
-        return "∃" + str(tree.children[0]) + " ∈ " + self.visit(tree.children[1])
+    def exists_cond(self, tuple_name, ram_relname):
+        return f"∃{tuple_name} ∈ {self.visit(ram_relname)}"
 
-    def isempty_cond(self, tree):
-        return self.visit(tree.children[0]) + " = ∅"
+    def isempty_cond(self, ram_relname):
+        return self.visit(ram_relname) + " = ∅"
 
-    def comparision(self, tree):
-        return (
-            self.visit(tree.children[0])
-            + f" {str(tree.children[1])} "
-            + self.visit(tree.children[2])
-        )
-
-    def bracketed_cond(self, tree):
-        return f"({self.visit(tree.children[0])})"
+    def comparision(self, lop, comparator, rop):
+        return f"{self.visit(lop)} {comparator} {self.visit(rop)}"
 
-    def tuple_expr(self, tree):
-        return f"〈{','.join(self.visit_children(tree))}〉"
+    def bracketed_cond(self, subcond):
+        return f"({self.visit(subcond)})"
 
-    def add_tuple_element(self, tree):
-        return " + ".join(self.visit_children(tree))
-
-    def sub_tuple_element(self, tree):
-        return " - ".join(self.visit_children(tree))
+    def tuple_expr(self, *elements):
+        visit = self.visit
+        return f"〈{','.join([visit(element) for element in elements])}〉"
 
     def undef(self, _):
         return "_"
 
-    def tuple_element_literal(self, tree):
-        return str(tree.children[0])
-
-    def tuple_element_ref(self, tree):
-        tuple_name = str(tree.children[0])
-
-        colname = str(tree.children[1])
-        if tuple_name in self._bound_tuples:
-            # NOTE: We need this check because tuple_element_ref can also be used for indexing into types.
-            colname = self._bound_tuples[tuple_name].attrs[int(colname)][0]
-
-        return ".".join([tuple_name, colname])
-
-    def functor_call(self, tree):
-        return (
-            self._safe_visit(tree.children[0])
-            + "("
-            + ",".join(map(self.visit, tree.children[1:]))
-            + ")"
-        )
-
-    def userdef_functor(self, tree):
-        return "@" + self.visit(tree.children[0])
-
-    def bracketed_tuple_element(self, tree):
-        return f"({self.visit(tree.children[0])})"
-
-    def record_tuple_element(self, tree):
-        return "[" + ",".join(self.visit_children(tree)) + "]"
+    def tuple_element_literal(self, literal):
+        return str(literal)
+
+    def tuple_element_ref(self, tuple_name, colname):
+        tuple_name = str(tuple_name)
+        colname = str(colname)
+
+        # NOTE: We need this check because tuple_element_ref can also be used for indexing into types.
+        rel = self._bound_tuples.get(tuple_name)
+        key = (tuple_name, colname, id(rel))
+        ref_cache = self._ref_cache
+        ref = ref_cache.get(key)
+        if ref is None:
+            if rel is not None:
+                colname = rel.col_names[int(colname)]
+            ref = ref_cache[key] = f"{tuple_name}.{colname}"
+        return ref
+
+    def functor_call(self, functor, *args):
+        visit = self.visit
+        return visit(functor) + "(" + ",".join([visit(arg) for arg in args]) + ")"
+
+    def userdef_functor(self, name):
+        return f"@{name}"
+
+    def intrinsic_functor(self, name):
+        return str(name)
+
+    def bracketed_tuple_element(self, element):
+        return f"({self.visit(element)})"
+
+    def record_tuple_element(self, *elements):
+        visit = self.visit
+        return "[" + ",".join([visit(element) for element in elements]) + "]"
+
+    def ram_relname(self, relkind, relname):
+        return self._cached_relname(relkind, str(relname))
+
+    def _cached_relname(self, relkind, relname: str) -> str:
+        if relkind is not None:
+            relkind = str(relkind)
+
+        key = (relkind, relname)
+        formatted = self._relname_cache.get(key)
+        if formatted is None:
+            formatted = self._relname_cache[key] = self._format_relname(
+                relkind, relname
+            )
+        return formatted
 
-    def ram_relname(self, tree):
-        relname = self.visit(tree.children[-1])
+    @staticmethod
+    def _format_relname(relkind: Optional[str], relname: str) -> str:
         prefix = ""
-        if len(tree.children) > 1:
-            relkind = str(tree.children[0])
-
+        if relkind is not None:
             if relkind == "@new_":
                 prefix = "Δ[i+1]"
             elif relkind == "@delta_":
@@ -328,35 +395,5 @@ class TextualPlanVisitor(Interpreter):
 
     ### Building blocks
 
-    def io_option(self, tree):
-        return self.visit_children(tree)
-
-    def tab_list(self, tree):
-        return "\t".join(map(str, tree.children))
-
-    def qualified_name(self, tree):
-        return ".".join(map(str, tree.children))
-
-    def object(self, tree):
-        return dict(map(self.visit, tree.children))
-
-    def array(self, tree):
-        return list(map(self.visit, tree.children))
-
-    def pair(self, tree):
-        return (str(tree.children[0]), self.visit(tree.children[1]))
-
-    def string(self, tree):
-        return str(tree.children[0])
-
-    def number(self, tree):
-        return int(tree.children[0])
-
-    def true(self, _):
-        return True
-
-    def false(self, _):
-        return False
-
-    def null(self, _):
-        return None
+    def io_option(self, name, value):
+        return (str(name), unescape_string(value))
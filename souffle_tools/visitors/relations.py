@@ -1,15 +1,22 @@
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, field
 from typing import List, Tuple
 
+from lark.tree import Tree
 from lark.visitors import Interpreter
 
-from .utils import children_by_name
+from .utils import children_by_name, rule_handlers
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Relation:
     relname: str
     attrs: List[Tuple[str, str]]
+    col_names: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # NOTE: column names are looked up by index for every tuple element reference.
+        object.__setattr__(self, "col_names", tuple([name for name, _ in self.attrs]))
 
     def __str__(self):
         return (
@@ -32,10 +39,29 @@ class RelationVisitor(Interpreter):
 
     def __init__(self):
         self.rels = {}
+        self._program = None
+        self._handlers = rule_handlers(self)
+
+    def visit(self, tree):
+        handler = self._handlers.get(tree.data)
+        if handler is None:
+            return self.__default__(tree)
+        return handler(tree)
+
+    def __default__(self, tree):
+        for child in tree.children:
+            if isinstance(child, Tree):
+                self.visit(child)
+
+    def program(self, tree):
+        # NOTE: the relations only depend on the program, so visiting it again is a no-op.
+        if tree is self._program:
+            return
+        self._program = tree
+        self.__default__(tree)
 
     def relation_decl(self, tree):
-        relname = self.qualified_name(tree.children[0])
-        assert isinstance(relname, str)
+        relname = sys.intern(str(tree.children[0]))
 
         attrs = []
         for attr in children_by_name(tree, "attribute"):
@@ -62,4 +88,4 @@ class RelationVisitor(Interpreter):
         return "float"
 
     def qualified_name(self, tree) -> str:
-        return ".".join(map(str, tree.children))
+        return str(tree.children[0])
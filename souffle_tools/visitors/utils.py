@@ -1,6 +1,11 @@
-from typing import Generator
+import ast
+import re
+from typing import Callable, Dict, Generator
 from lark.lexer import Token
 from lark.tree import Tree
+from lark.visitors import Interpreter
+
+_STRATUM_RE = re.compile(r"_(\d+)")
 
 
 def children_by_name(tree: Tree, name: str) -> Generator[Token | Tree, None, None]:
@@ -10,5 +15,46 @@ def children_by_name(tree: Tree, name: str) -> Generator[Token | Tree, None, Non
             yield child
 
 
-def has_child(tree: Tree, name: str) -> bool:
-    return any(getattr(child, "data", None) == name for child in tree.children)
+def unescape_string(token: Token) -> str:
+    """
+    Decode a quoted string literal from the compiler's output.
+    """
+    literal = str(token)
+    # NOTE: most literals have no escapes, and can just be unquoted.
+    if "\\" not in literal:
+        return literal[1:-1]
+    return ast.literal_eval(literal)
+
+
+def rule_handlers(visitor: Interpreter) -> Dict[str, Callable]:
+    """
+    Bind the rule methods of a visitor, keyed by rule name.
+
+    Rules are looked up along the visitor's MRO, so inherited and overridden rules are included.
+    Dispatching through this table saves the getattr done by Interpreter on every node.
+    """
+    handlers: Dict[str, Callable] = {}
+    for cls in type(visitor).__mro__:
+        # NOTE: the Interpreter's own methods are not rules.
+        if cls in Interpreter.__mro__:
+            continue
+        for name, attr in vars(cls).items():
+            if (
+                name.startswith("_")
+                or name in handlers
+                or hasattr(Interpreter, name)
+                or not callable(attr)
+            ):
+                continue
+            handlers[name] = getattr(visitor, name)
+    return handlers
+
+
+def stratum_number(subroutine: Tree) -> int:
+    """
+    Order of a RAM subroutine in the program, taken from its name.
+
+    bit of a HACK: depends on stratum names used by the souffle compiler.
+    """
+    match = _STRATUM_RE.search(str(subroutine.children[0]))
+    return int(match.group(1)) if match else -1